@@ -8,32 +8,128 @@ Precise definition of Qiita Contribution:
 from __future__ import annotations
 from typing import Dict, Optional
 import os
-import math
-import requests
+import csv
+import json
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from operator import itemgetter
+import aiohttp
+import orjson
+import numpy as np
+from aiohttp_client_cache import CachedSession, SQLiteBackend
 from datetime import datetime, timedelta
 from argparse import ArgumentParser, RawTextHelpFormatter
 
 QIITA_APIv2_URL = 'https://qiita.com/api/v2/'
-PER_PAGE = 10
+PER_PAGE = 100  # the maximum per_page of Qiita API v2
+MAX_CONCURRENCY = 16
+ETAG_CACHE = 'qiita_etag_cache.json'
+RATE_MARGIN = MAX_CONCURRENCY * 2
+VERBOSE = False
+_ITEM_CACHE: Dict[str, 'Item'] = dict()
+
+
+def vprint(msg: str) -> None:
+    '''print progress only when --verbose is given'''
+    if VERBOSE:
+        print(msg)
+
+
+@asynccontextmanager
+async def api_get(
+    session: aiohttp.ClientSession,
+    sem: asyncio.Semaphore,
+    url: str,
+    **kwargs
+):
+    '''GET with awareness of the Qiita API rate limit
+
+    Qiita allows 1000 requests per hour per token and reports
+    the budget in the Rate-Remaining/Rate-Reset response headers.
+    wait for the reset proactively when the budget is nearly
+    exhausted, and honor Retry-After when a 429 slips through.
+    '''
+    while True:
+        async with sem:
+            async with session.get(url, **kwargs) as res:
+                if res.status == 429:
+                    retry_after = int(res.headers.get('Retry-After', '60'))
+                    print(f'rate limited: wait {retry_after} seconds')
+                    await asyncio.sleep(retry_after)
+                    continue
+                yield res
+                if getattr(res, 'from_cache', False):
+                    return
+                remaining = res.headers.get('Rate-Remaining')
+                reset = res.headers.get('Rate-Reset')
+                if remaining is not None and reset is not None:
+                    if int(remaining) < RATE_MARGIN:
+                        wait = int(reset) - time.time()
+                        if wait > 0:
+                            print(
+                                'rate nearly exhausted:'
+                                f' wait {wait:.0f} seconds'
+                            )
+                            await asyncio.sleep(wait)
+                return
+
+
+class EtagCache(object):
+    '''sidecar cache for conditional GETs
+
+    persists the ETag of the stocker list of each item
+    and the fields derived from it, so that unchanged items
+    can be answered with a bodyless 304 response on later runs
+    '''
+    def __init__(self: EtagCache) -> None:
+        self.entries = dict()
+        if os.path.exists(ETAG_CACHE):
+            with open(ETAG_CACHE, 'rt') as rf:
+                self.entries = json.load(rf)
+        return
+
+    def get_etag(self: EtagCache, item_id: str) -> Optional[str]:
+        entry = self.entries.get(item_id)
+        if entry is None:
+            return None
+        return entry['etag']
+
+    def get_fields(self: EtagCache, item_id: str) -> Dict:
+        return self.entries[item_id]['fields']
+
+    def put(
+        self: EtagCache,
+        item_id: str,
+        etag: str,
+        fields: Dict
+    ) -> None:
+        self.entries[item_id] = {
+            'etag': etag,
+            'fields': fields,
+        }
+        return
+
+    def save(self: EtagCache) -> None:
+        with open(ETAG_CACHE, 'wt') as wf:
+            json.dump(self.entries, wf)
+        return
 
 
 class User(object):
     '''retrieve user information
 
     Args:
-        token str: Qiita Personal Access Token
         user_id str: Qiita user ID
         start Optional[datetime]: The day to start counting items
         end Optional[datetime]: The day to finish counting items
     '''
     def __init__(
         self: User,
-        token: str,
         user_id: str,
         start: Optional[datetime],
         end: Optional[datetime]
     ) -> None:
-        self.token = token
         self.user_id = user_id
         self.start = start
         self.end = end
@@ -45,64 +141,130 @@ class User(object):
         self.comments_count = 0
         self.contribution = 0
         self.items = list()
-        self.headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.token}',
-        }
-        print(f'retrieving user_id: {self.user_id}')
-        url = os.path.join(
-            QIITA_APIv2_URL, 'users', self.user_id
-        )
-        user = requests.get(url, headers=self.headers).json()
+        return
+
+    @classmethod
+    async def create(
+        cls,
+        user_id: str,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        session: aiohttp.ClientSession,
+        sem: asyncio.Semaphore,
+        etag_cache: EtagCache
+    ) -> User:
+        '''retrieve user information concurrently and create an instance
+        '''
+        self = cls(user_id=user_id, start=start, end=end)
+        vprint(f'retrieving user_id: {self.user_id}')
+        url = f'{QIITA_APIv2_URL}users/{self.user_id}'
+        async with api_get(session=session, sem=sem, url=url) as res:
+            user = await res.json(loads=orjson.loads)
         self.followees_count = user['followees_count']
         self.followers_count = user['followers_count']
-        self._get_items()
+        await self._get_items(
+            session=session, sem=sem, etag_cache=etag_cache
+        )
         self._calc_contribution()
-        return
+        return self
 
-    def _get_items(self: User) -> None:
+    async def _get_items(
+        self: User,
+        session: aiohttp.ClientSession,
+        sem: asyncio.Semaphore,
+        etag_cache: EtagCache
+    ) -> None:
         '''retrieve items which was written by this user
+
+        the first response carries the total number of items in
+        the Total-Count header, so all remaining pages can be
+        requested at once instead of probing for the last page
         '''
-        page = 1
-        url = os.path.join(
-            QIITA_APIv2_URL, 'users', self.user_id, 'items'
-        )
-        print('retrieving items', end='', flush=True)
-        while True:
-            params = {
-                'page': str(page),
-                'per_page': str(PER_PAGE),
-            }
-            print(f' {PER_PAGE * page}...', end='', flush=True)
-            items = requests.get(
-                url, params=params, headers=self.headers
-            ).json()
-            for item in items:
-                self.items.append(Item(
-                    token=self.token,
-                    item_id=item['id'],
-                    start=self.start,
-                    end=self.end
-                ))
-            if len(items) < PER_PAGE:
-                break
-            page += 1
-        print('')
+        async with api_get(
+            session=session, sem=sem,
+            url=f'{QIITA_APIv2_URL}users/{self.user_id}/items',
+            params={'page': '1', 'per_page': str(PER_PAGE)}
+        ) as res:
+            total_count = res.headers.get('Total-Count')
+            listings = await res.json(loads=orjson.loads)
+        if total_count is not None:
+            vprint(f'retrieving {total_count} items of {self.user_id}')
+            n_pages = -(-int(total_count) // PER_PAGE)
+            pages = await asyncio.gather(*[
+                self._get_items_page(session=session, sem=sem, page=page)
+                for page in range(2, n_pages + 1)
+            ])
+            for items in pages:
+                listings.extend(items)
+        else:
+            # fallback: probe page by page until a short page arrives
+            vprint(f'retrieving items of {self.user_id}')
+            page = 2
+            items = listings
+            while len(items) == PER_PAGE:
+                items = await self._get_items_page(
+                    session=session, sem=sem, page=page
+                )
+                listings.extend(items)
+                page += 1
+        for item in listings:
+            self.items.append(Item.get_or_create(
+                item_id=item['id'],
+                start=self.start,
+                end=self.end,
+                listing=item
+            ))
+        await asyncio.gather(*[
+            item._fetch(session=session, sem=sem, etag_cache=etag_cache)
+            for item in self.items
+        ])
         return
 
+    async def _get_items_page(
+        self: User,
+        session: aiohttp.ClientSession,
+        sem: asyncio.Semaphore,
+        page: int
+    ) -> list:
+        '''retrieve one page of the item listing
+        '''
+        async with api_get(
+            session=session, sem=sem,
+            url=f'{QIITA_APIv2_URL}users/{self.user_id}/items',
+            params={'page': str(page), 'per_page': str(PER_PAGE)}
+        ) as res:
+            return await res.json(loads=orjson.loads)
+
     def _calc_contribution(self: User) -> None:
         '''calculate simplified Qiita Contribution
+
+        accumulate per-item counts as NumPy reductions
+        instead of a pure-Python loop
+        (invalid items hold zero counts, so no masking is needed)
         '''
-        contribution = 0
-        for item in self.items:
-            self.items_count += 1 if item.is_valid else 0
-            self.likes_count += item.likes_count
-            self.stockers_count += item.stockers_count
-            self.comments_count += item.comments_count
-        contribution = self.items_count
-        contribution += self.likes_count
-        contribution += 0.5 * self.stockers_count
-        self.contribution = int(math.floor(contribution + 0.5))
+        n_items = len(self.items)
+        self.items_count = int(np.fromiter(
+            (item.is_valid for item in self.items),
+            dtype=bool, count=n_items
+        ).sum())
+        self.likes_count = int(np.fromiter(
+            (item.likes_count for item in self.items),
+            dtype=np.int64, count=n_items
+        ).sum())
+        self.stockers_count = int(np.fromiter(
+            (item.stockers_count for item in self.items),
+            dtype=np.int64, count=n_items
+        ).sum())
+        self.comments_count = int(np.fromiter(
+            (item.comments_count for item in self.items),
+            dtype=np.int64, count=n_items
+        ).sum())
+        self.contribution = int(
+            self.items_count
+            + self.likes_count
+            + 0.5 * self.stockers_count
+            + 0.5
+        )
         return
 
     def get_contribution(self: User) -> Dict:
@@ -124,68 +286,176 @@ class Item(object):
     '''retrieve item information
 
     Args:
-        token str: Qiita Personal Access Token
         item_id str: Qiita item ID
         start Optional[datetime]: The day to start counting items
         end Optional[datetime]: The day to finish counting items
+        listing Dict: the payload of this item in the item listing
     '''
     def __init__(
         self: Item,
-        token: str,
         item_id: str,
         start: Optional[datetime],
-        end: Optional[datetime]
+        end: Optional[datetime],
+        listing: Dict
     ) -> None:
-        self.token = token
         self.item_id = item_id
         self.start = start
         self.end = end
+        self.listing = listing
         self.is_valid = False
+        self._fetch_task = None
         self.likes_count = 0
         self.stockers_count = 0
         self.comments_count = 0
-        self.headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {self.token}',
-        }
-        url = os.path.join(
-            QIITA_APIv2_URL, 'items', self.item_id
+        return
+
+    @classmethod
+    def get_or_create(
+        cls,
+        item_id: str,
+        start: Optional[datetime],
+        end: Optional[datetime],
+        listing: Dict
+    ) -> Item:
+        '''memoize instances per item ID
+
+        the same item can appear in several listings of
+        a multi-user batch run; reuse the already fetched instance
+        instead of requesting the same endpoint again
+        '''
+        cached = _ITEM_CACHE.get(item_id)
+        if (
+            cached is not None
+            and cached.start == start
+            and cached.end == end
+        ):
+            return cached
+        item = cls(
+            item_id=item_id,
+            start=start,
+            end=end,
+            listing=listing
         )
-        item = requests.get(url, headers=self.headers).json()
-        self.created_at = datetime.strptime(
-            item['created_at'][:19],
-            '%Y-%m-%dT%H:%M:%S'
+        _ITEM_CACHE[item_id] = item
+        return item
+
+    async def _fetch(
+        self: Item,
+        session: aiohttp.ClientSession,
+        sem: asyncio.Semaphore,
+        etag_cache: EtagCache
+    ) -> None:
+        '''retrieve the information of this item
+
+        the retrieval itself runs exactly once per instance;
+        when users sharing this item are gathered concurrently,
+        later callers await the already running task instead of
+        returning before the fields are filled in
+        '''
+        if self._fetch_task is None:
+            self._fetch_task = asyncio.ensure_future(self._fetch_once(
+                session=session, sem=sem, etag_cache=etag_cache
+            ))
+        await self._fetch_task
+        return
+
+    async def _fetch_once(
+        self: Item,
+        session: aiohttp.ClientSession,
+        sem: asyncio.Semaphore,
+        etag_cache: EtagCache
+    ) -> None:
+        '''retrieve the information of this item
+
+        the item listing already contains every field except
+        the stockers count, so no request is needed at all for
+        items which fall outside of the counting period
+        '''
+        self.created_at = datetime.fromisoformat(
+            self.listing['created_at'][:19]
         )
-        self.updated_at = datetime.strptime(
-            item['updated_at'][:19],
-            '%Y-%m-%dT%H:%M:%S'
+        self.updated_at = datetime.fromisoformat(
+            self.listing['updated_at'][:19]
         )
         if self.start is not None and self.updated_at < self.start:
             return
         if self.end is not None and self.created_at > self.end:
             return
         self.is_valid = True
-        self.likes_count = item['likes_count']
-        self.comments_count = item['comments_count']
-        self.stockers_count = self._get_stockers_count()
+        self.likes_count = self.listing['likes_count']
+        self.comments_count = self.listing['comments_count']
+        self.stockers_count = await self._get_stockers_count(
+            session=session, sem=sem, etag_cache=etag_cache
+        )
         return
 
-    def _get_stockers_count(self: Item) -> int:
+    async def _get_stockers_count(
+        self: Item,
+        session: aiohttp.ClientSession,
+        sem: asyncio.Semaphore,
+        etag_cache: EtagCache
+    ) -> int:
         '''retrieve the number of stockers who stocks this item
+
+        Qiita API v2 returns the total number of entries of
+        a list endpoint in the Total-Count response header,
+        so one minimal request is enough to count stockers.
+        send If-None-Match with the ETag of the last run;
+        an unchanged stocker list is answered with
+        a bodyless 304 and the count of the sidecar cache is reused.
+        '''
+        url = f'{QIITA_APIv2_URL}items/{self.item_id}/stockers'
+        params = {
+            'page': '1',
+            'per_page': '1',
+        }
+        headers = dict()
+        etag = etag_cache.get_etag(self.item_id)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        async with api_get(
+            session=session, sem=sem, url=url,
+            params=params, headers=headers
+        ) as res:
+            if res.status == 304:
+                return etag_cache.get_fields(
+                    self.item_id
+                )['stockers_count']
+            etag = res.headers.get('ETag')
+            total_count = res.headers.get('Total-Count')
+        if total_count is not None:
+            stockers_count = int(total_count)
+        else:
+            stockers_count = await self._count_stockers_paging(
+                session=session, sem=sem
+            )
+        if etag is not None:
+            etag_cache.put(self.item_id, etag, {
+                'stockers_count': stockers_count,
+            })
+        return stockers_count
+
+    async def _count_stockers_paging(
+        self: Item,
+        session: aiohttp.ClientSession,
+        sem: asyncio.Semaphore
+    ) -> int:
+        '''count stockers by walking every page
+        (fallback when the Total-Count header is missing)
         '''
         stockers_count = 0
         page = 1
-        url = os.path.join(
-            QIITA_APIv2_URL, 'items', self.item_id, 'stockers'
-        )
+        url = f'{QIITA_APIv2_URL}items/{self.item_id}/stockers'
+        params = {
+            'page': str(page),
+            'per_page': str(PER_PAGE),
+        }
         while True:
-            params = {
-                'page': str(page),
-                'per_page': str(PER_PAGE),
-            }
-            stockers = requests.get(
-                url, params=params, headers=self.headers
-            ).json()
+            params['page'] = str(page)
+            async with api_get(
+                session=session, sem=sem, url=url, params=params
+            ) as res:
+                stockers = await res.json(loads=orjson.loads)
             stockers_count += len(stockers)
             if len(stockers) < PER_PAGE:
                 break
@@ -193,6 +463,60 @@ class Item(object):
         return stockers_count
 
 
+async def main_async(
+    token: str,
+    user_ids: list,
+    start: Optional[datetime],
+    end: Optional[datetime]
+) -> list:
+    '''retrieve the information of each user
+
+    one ClientSession (= one connection pool) is shared
+    among all users to keep TCP+TLS connections alive,
+    and GET responses are cached on disk (SQLite) so that
+    repeated runs do not hit the Qiita API again
+    '''
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {token}',
+    }
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENCY * 2)
+    cache = SQLiteBackend(
+        cache_name='qiita_cache',
+        expire_after=3600,
+        cache_control=True
+    )
+    etag_cache = EtagCache()
+
+    async def retrieve_user(
+        session: aiohttp.ClientSession, user_id: str
+    ) -> Optional[Dict]:
+        try:
+            user = await User.create(
+                user_id=user_id,
+                start=start,
+                end=end,
+                session=session,
+                sem=sem,
+                etag_cache=etag_cache
+            )
+        except Exception as e:
+            print(e)
+            return None
+        return user.get_contribution()
+
+    async with CachedSession(
+        cache=cache, headers=headers, connector=connector
+    ) as session:
+        results = await asyncio.gather(*[
+            retrieve_user(session=session, user_id=user_id)
+            for user_id in user_ids
+        ])
+    etag_cache.save()
+    return [x for x in results if x is not None]
+
+
 def main() -> None:
     parser = ArgumentParser(
         description=(
@@ -223,6 +547,10 @@ def main() -> None:
             '  (default: None = unlimited)'
         )
     )
+    parser.add_argument(
+        '-v', '--verbose', action='store_true',
+        help='print the progress of the retrieval'
+    )
     parser.add_argument(
         '-o', '--output', type=str, default='qiita_contributions.csv',
         help=(
@@ -231,6 +559,8 @@ def main() -> None:
         )
     )
     args = parser.parse_args()
+    global VERBOSE
+    VERBOSE = args.verbose
     token = args.token
     user_ids = [x.strip() for x in args.users.split(',')]
     start = None
@@ -241,35 +571,25 @@ def main() -> None:
         end = datetime.strptime(args.end, '%Y%m%d')
         end += timedelta(days=1)
         end -= timedelta(seconds=1)
-    contributions = list()
-    for user_id in user_ids:
-        try:
-            user = User(
-                token=token,
-                user_id=user_id,
-                start=start,
-                end=end
-            )
-        except Exception as e:
-            print(e)
-            continue
-        contributions.append(user.get_contribution())
+    contributions = asyncio.run(main_async(
+        token=token,
+        user_ids=user_ids,
+        start=start,
+        end=end
+    ))
     if len(contributions) < 1:
         raise ValueError('No user was able to get the information')
     columns = [
         'user_id', 'followees', 'followers', 'items',
         'likes', 'stockers', 'comments', 'contribution',
     ]
-    with open(args.output, 'wt') as wf:
-        wf.write(','.join(['rank'] + columns) + '\n')
-        for i, contribution in enumerate(sorted(
-            contributions,
-            key=lambda x: x['contribution'],
-            reverse=True
-        )):
-            wf.write(','.join([str(i + 1)] + [
-                str(contribution[c]) for c in columns
-            ]) + '\n')
+    contributions.sort(key=itemgetter('contribution'), reverse=True)
+    get_columns = itemgetter(*columns)
+    with open(args.output, 'wt', newline='') as wf:
+        writer = csv.writer(wf)
+        writer.writerow(['rank'] + columns)
+        for i, contribution in enumerate(contributions):
+            writer.writerow((i + 1,) + get_columns(contribution))
     return
 
 